@@ -25,12 +25,20 @@
 #       Added output option, ready for web server usage
 # Version 0.5 / 2024-05-26
 #       Some improvements
+# Version 0.6 / 2026-10-15
+#       Faster image acquisition, bounded wait for image data
+#       Added hot pixels option
+#       Output image is replaced atomically
 
 # Standard library
+import os
+import io
 import sys
+import math
 import argparse
 import time
 import threading
+import queue
 
 # Extra modules, not part of standard library, on Ubuntu install via apt-get
 import PyIndi
@@ -40,27 +48,48 @@ import numpy as np
 from icecream import ic
 # Disable debugging
 ic.disable()
+# Set by -d --debug, guards ic() calls in hot paths
+DEBUG = False
 
 # Local modules
 from verbose import verbose, warning, error
 
 
-VERSION = "0.5 / 2024-05-26"
+VERSION = "0.6 / 2026-10-15"
 AUTHOR  = "Martin Junius"
 NAME    = "qhy5-auto"
 DESC    = "INDI client, capture frames from QHY5L with auto-exposure"
 
-# INDI timeout for getXXX() functions (seconds)
-TIMEOUT = 0.1
+# Timeout waiting for INDI device and properties (seconds)
+TIMEOUT = 5.0
 # Default server:port
 HOST    = "localhost"
 PORT    = 7624
+# Extra time to wait for image data after exposure time (seconds)
+BLOBTIMEOUT = 2.0
+# Optional delay after image data arrived (seconds), formerly hard-coded 0.1 s
+# workaround for early terminate errors, set QHY5_SETTLE=0.1 if needed
+SETTLE  = float(os.environ.get("QHY5_SETTLE", 0))
 # Max numbers of auto-exposure attempts
 MAXTRY  = 15
 # Expected mean ADU (0..255) and deviation
 MEANADU = 128
 DEVADU  = 20
 EXPOSURE_THRESHOLD = 1.0 # s
+# Exposure time range below EXPOSURE_THRESHOLD used with gain > MINGAIN
+EXPOSURE_RANGE = 4
+# Mean ADU of a saturated image, exposure time is reduced by SATSTEP
+SATADU  = 250
+SATSTEP = 16
+# Percentiles stretched to 0 .. 255 for the output image
+STRETCH_LOW  = 0.005
+STRETCH_HIGH = 0.995
+# Quality of JPEG output image, good enough for a preview
+JPEG_QUALITY = 75
+# Hot pixel threshold, standard deviations above mean of 8 neighbours
+HOTSIGMA = 5
+# Use every AESTEP-th pixel in x and y for the auto-exposure statistics
+AESTEP  = 4
 
 
 # QHY 5L II mono:
@@ -75,6 +104,9 @@ MAXOFFSET = 512
 MINEXP    = 0.000001
 MAXEXP    = 8          # camera allows max 3600 s, but would be too long ;-)
 
+# CCD properties used by IndiClient, defined by the driver after connect
+CCD_PROPERTIES = ("CCD_EXPOSURE", "CCD_BINNING", "CCD_GAIN", "CCD_OFFSET", "CCD_INFO", "CCD1")
+
 
 
 # Command line options
@@ -86,6 +118,119 @@ class Options:
     exposure = 0.5                          # -e --exposure
     binning  = 2                            # -b --binning
     output   = "./blob.jpg"                 # -O --output
+    hot_pixels = False                      # -H --hot-pixels
+
+
+
+# Auto-exposure step for an exposure outside MEANADU +/- DEVADU: returns the
+# next exposure time, limited to min_exp ... max_exp, and the updated last
+# too dark (lo_exp) / too bright (hi_exp) exposure times
+def ae_step(mean, exp, lo_exp, hi_exp, min_exp, max_exp):
+    if mean >= MEANADU + DEVADU:
+        hi_exp = exp
+    else:
+        lo_exp = exp
+    if lo_exp and hi_exp:
+        # bisection (log scale) between too dark and too bright
+        new_exp = math.sqrt(lo_exp * hi_exp)
+    elif mean >= SATADU:
+        # saturated, mean ADU doesn't tell how much
+        new_exp = exp / SATSTEP
+    else:
+        # mean ADU is roughly proportional to exposure time
+        new_exp = exp * MEANADU / max(mean, 1)
+    return min(max(new_exp, min_exp), max_exp), lo_exp, hi_exp
+
+
+
+# FITS parser for the camera image data. All frames taken with the same camera
+# settings have the same header layout, so after the first header has been
+# parsed by astropy the pixels are read directly from the buffer.
+# The returned image is only valid until the next call of parse(), 16 bit
+# data is converted into a buffer reused for all frames with the same layout.
+class FITSParser:
+    # mandatory first cards SIMPLE, BITPIX, NAXIS, NAXIS1, NAXIS2
+    KEYLEN = 5 * 80
+    BITPIX2DTYPE = { 8: np.dtype("u1"), 16: np.dtype(">u2") }
+
+    def __init__(self):
+        self.layout = None
+        self.buffer = None
+        # (size, mandatory cards) of the last layout not supported by fast path
+        self.unsupported = None
+
+    def parse(self, data):
+        mv = memoryview(data)
+        if self.unsupported and self.unsupported[0] == len(mv) and mv[:self.KEYLEN] == self.unsupported[1]:
+            # same unsupported layout as before, don't read the header again
+            return self._parseAstropy(data)
+        for _ in range(2):
+            if not self.layout:
+                self.layout = self._getLayout(data)
+                if not self.layout:
+                    self.unsupported = (len(mv), bytes(mv[:self.KEYLEN]))
+                    break
+                self.unsupported = None
+                key, size, offset, shape, dtype = self.layout
+                if dtype.itemsize == 2:
+                    self.buffer = np.empty(shape, dtype=np.uint16)
+            key, size, offset, shape, dtype = self.layout
+            try:
+                # same mandatory cards and same total size, optional header
+                # cards may come and go and shift the data offset
+                if len(mv) != size or mv[:self.KEYLEN] != key:
+                    raise ValueError("FITS header changed")
+                img = np.frombuffer(mv, dtype=dtype, count=shape[0] * shape[1], offset=offset).reshape(shape)
+            except ValueError as e:
+                if DEBUG: ic(e)
+                self.layout = None
+                continue
+            if dtype.itemsize == 2:
+                # 16 bit FITS data is big endian signed with BZERO=32768,
+                # the XOR yields native uint16 in a single pass
+                img = np.bitwise_xor(img, np.uint16(0x8000), out=self.buffer)
+            return img
+
+        return self._parseAstropy(data)
+
+    def _parseAstropy(self, data):
+        # Not supported by fast path, let astropy handle it, fromstring()
+        # only accepts bytes
+        hdul = fits.HDUList.fromstring(data if isinstance(data, bytes) else bytes(data))
+        # hdul.info()
+        img = hdul[0].data
+        # FITS data may be big endian, OpenCV needs native byte order
+        return np.ascontiguousarray(img.astype(img.dtype.newbyteorder("="), copy=False))
+
+    def _getLayout(self, data):
+        # only the primary header is read, data offset and padded data size
+        # from astropy's file info
+        try:
+            with fits.open(io.BytesIO(data), lazy_load_hdus=True) as hdul:
+                header = hdul[0].header
+                info   = hdul.fileinfo(0)
+        except OSError:
+            return None
+        bitpix = header["BITPIX"]
+        if header["NAXIS"] != 2 or header.get("BSCALE", 1) != 1 or \
+           (bitpix, header.get("BZERO", 0)) not in ((8, 0), (16, 32768)):
+            return None
+        return (bytes(data[:self.KEYLEN]), info["datLoc"] + info["datSpan"], info["datLoc"],
+                (header["NAXIS2"], header["NAXIS1"]), self.BITPIX2DTYPE[bitpix])
+
+
+
+# Replace hot pixels with the mean of their 8 neighbours, the 3x3 sums via
+# cv2.boxFilter() avoid a full median filter
+def remove_hot_pixels(img):
+    # float64, E[x^2] - E[x]^2 loses all precision in float32 for 16 bit data
+    f  = img.astype(np.float64)
+    s  = cv2.boxFilter(f,     -1, (3, 3), normalize=False) - f
+    sq = cv2.boxFilter(f * f, -1, (3, 3), normalize=False) - f * f
+    mean = s / 8
+    std  = np.sqrt(np.maximum(sq / 8 - mean * mean, 0))
+    hot  = f > mean + HOTSIGMA * np.maximum(std, 1)
+    return np.where(hot, mean.astype(img.dtype), img)
 
 
 
@@ -94,6 +239,17 @@ class IndiClient(PyIndi.BaseClient):
     def __init__(self, host=HOST, port=PORT):
         super(IndiClient, self).__init__()
         verbose(f"creating an instance of IndiClient, server {host}:{port}")
+        # image data received by updateProperty(), per instance
+        self._blob_lock  = threading.Lock()
+        self._blob_data  = None
+        self._blob_event = threading.Event()
+        # FITS parser for image data, see CCDgetImg()
+        self._fits = FITSParser()
+        # set by newProperty() when the camera properties are available
+        self._properties = set()
+        self._device_ready = threading.Event()
+        self._attrs_ready  = threading.Event()
+        self.watchDevice(Options.camera)
         self.setServer(host, port)
         if not self.connectServer():
             error("can't connect to indiserver")
@@ -112,6 +268,13 @@ class IndiClient(PyIndi.BaseClient):
         # verbose(
         #     f"new property {p.getName()} as {p.getTypeAsString()} for device {p.getDeviceName()}"
         # )
+        if p.getDeviceName() != Options.camera:
+            return
+        self._properties.add(p.getName())
+        if p.getName() == "CONNECTION":
+            self._device_ready.set()
+        if self._properties.issuperset(CCD_PROPERTIES):
+            self._attrs_ready.set()
 
     # def updateProperty(self, p):
     #     """Emmited when a new property value arrives from INDI server."""
@@ -144,74 +307,83 @@ class IndiClient(PyIndi.BaseClient):
     def updateProperty(self, prop):
         """Emmited when a new property value arrives from INDI server."""
         # verbose(f"update property {prop.getName()} as {prop.getTypeAsString()} for device {prop.getDeviceName()}")
-        global blobEvent
         if prop.getType() == PyIndi.INDI_BLOB:
-            ic(prop.getName())
-            blobEvent.set()
+            if DEBUG: ic(prop.getName())
+            blob = PyIndi.PropertyBlob(prop)[0]
+            if Options.new_message:
+                verbose(f"name {blob.getName()} size {blob.getSize()} format {blob.getFormat()}")
+            with self._blob_lock:
+                self._blob_data = blob.getblobdata()
+            self._blob_event.set()
 
 
     # Refactored from main()
     def verboseDevices(self):
         # list devices
-        while not (deviceList := self.getDevices()):
-            time.sleep(TIMEOUT)
-        for device in deviceList:
+        self._device_ready.wait(TIMEOUT)
+        for device in self.getDevices():
             verbose(f"device found: {device.getDeviceName()}")
 
 
-    def getCCDAttr(self, name):
-        while not (attr := self.device_ccd.getNumber(name)):
-            time.sleep(TIMEOUT)
-        return attr
-            
-
     def CCDconnect(self, ccd):
-        # Connect camera
-        while not (device_ccd := self.getDevice(ccd)):
-            time.sleep(TIMEOUT)
+        # Connect camera, driver may need a while to start (e.g. at boot)
+        while not self._device_ready.wait(TIMEOUT):
+            warning(f"camera {ccd} not found yet, waiting ...")
+        device_ccd = self.getDevice(ccd)
         self.device_ccd = device_ccd
-        while not (ccd_connect := device_ccd.getSwitch("CONNECTION")):
-            time.sleep(TIMEOUT)
+        ccd_connect = device_ccd.getSwitch("CONNECTION")
         if not device_ccd.isConnected():
             ccd_connect.reset()
             ccd_connect[0].setState(PyIndi.ISS_ON)  # the "CONNECT" switch
             self.sendNewProperty(ccd_connect)
 
-        self.ccd_exposure = self.getCCDAttr("CCD_EXPOSURE")
-        self.ccd_binning  = self.getCCDAttr("CCD_BINNING")
-        self.ccd_gain     = self.getCCDAttr("CCD_GAIN")
-        self.ccd_offset   = self.getCCDAttr("CCD_OFFSET")
-        self.ccd_info     = self.getCCDAttr("CCD_INFO")
+        # CCD properties are defined by the driver once the camera is connected
+        while not self._attrs_ready.wait(TIMEOUT):
+            warning(f"camera {ccd} properties not available yet, waiting ...")
+        self.ccd_exposure = device_ccd.getNumber("CCD_EXPOSURE")
+        self.ccd_binning  = device_ccd.getNumber("CCD_BINNING")
+        self.ccd_gain     = device_ccd.getNumber("CCD_GAIN")
+        self.ccd_offset   = device_ccd.getNumber("CCD_OFFSET")
+        self.ccd_info     = device_ccd.getNumber("CCD_INFO")
 
         self.current_binning  = Options.binning
         self.current_gain     = Options.gain 
         self.current_offset   = Options.offset 
         self.current_exposure = Options.exposure 
 
-        # inform the indi server that we want to receive the "CCD1" blob from this device
-        self.setBLOBMode(PyIndi.B_ALSO, ccd, "CCD1")
-        while not (ccd_ccd1 := device_ccd.getBLOB("CCD1")):
-            time.sleep(TIMEOUT)
-        self.ccd_ccd1 = ccd_ccd1
-
-        # we use here the threading.Event facility of Python
-        global blobEvent
-        blobEvent = threading.Event()
-
-
-    def CCDcapture(self):
-        # set gain and offset
-        self.ccd_gain[0].setValue(self.current_gain)
-        self.sendNewProperty(self.ccd_gain)
+        # offset and binning don't change, set once
         self.ccd_offset[0].setValue(self.current_offset)
         self.sendNewProperty(self.ccd_offset)
-        # set binning
         self.ccd_binning[0].setValue(self.current_binning)
         self.ccd_binning[1].setValue(self.current_binning)
         self.sendNewProperty(self.ccd_binning)
+        # gain is set by CCDcapture() when changed
+        self._last_gain = None
+        # FITS image data, qhy5-capture -R may have left the driver in native format
+        if (ccd_format := device_ccd.getSwitch("CCD_TRANSFER_FORMAT")):
+            for sw in ccd_format:
+                sw.setState(PyIndi.ISS_ON if sw.getName() == "FORMAT_FITS" else PyIndi.ISS_OFF)
+            self.sendNewProperty(ccd_format)
+
+        # inform the indi server that we want to receive the "CCD1" blob from this device,
+        # properties are only needed until here, values are set by this client
+        self.setBLOBMode(PyIndi.B_ONLY, ccd, "CCD1")
+        self.ccd_ccd1 = device_ccd.getBLOB("CCD1")
+
+        # background thread for writing images, holds only the latest image
+        self._write_q = queue.Queue(maxsize=1)
+        threading.Thread(target=self._writer, daemon=True).start()
+
+
+    def CCDcapture(self):
+        # set gain, if changed by auto-exposure
+        if self._last_gain != self.current_gain:
+            self.ccd_gain[0].setValue(self.current_gain)
+            self.sendNewProperty(self.ccd_gain)
+            self._last_gain = self.current_gain
 
         # start exposure
-        blobEvent.clear()
+        self._blob_event.clear()
         self.ccd_exposure[0].setValue(self.current_exposure)
         self.sendNewProperty(self.ccd_exposure)
 
@@ -222,23 +394,19 @@ class IndiClient(PyIndi.BaseClient):
         return self.current_exposure
 
 
+    # Returned image is only valid until the next call of CCDgetImg(),
+    # raises TimeoutError if no image data arrives
     def CCDgetImg(self):
-        # wait for exposure(s)
-        blobEvent.wait()
-        # seems to help with early terminate errors
-        time.sleep(0.1)
+        # wait for exposure, exposure time + download
+        if not self._blob_event.wait(self.current_exposure + BLOBTIMEOUT):
+            raise TimeoutError(f"no image data received for {self.current_exposure:.3g}s exposure")
+        if SETTLE:
+            time.sleep(SETTLE)
 
-        # process the received one
-        for blob in self.ccd_ccd1:
-            if Options.new_message:
-                verbose(f"name {blob.getName()} size {blob.getSize()} format {blob.getFormat()}")
-            # Directly convert bytearray to FITS
-            fitsdata = blob.getblobdata()
-            hdul = fits.HDUList.fromstring(bytes(fitsdata))
-            # hdul.info()
-            imgdata = hdul[0].data
+        with self._blob_lock:
+            fitsdata = self._blob_data
 
-            return imgdata
+        return self._fits.parse(fitsdata)
     
 
     def CCDsaveImg(self):
@@ -247,86 +415,150 @@ class IndiClient(PyIndi.BaseClient):
 
 
     def CCDwriteImg(self, img):
+        # queue for writer thread, replacing a not yet written image
+        # (copy, CCDgetImg() reuses the image buffer)
+        item = (img.copy(), self.current_exposure, self.current_gain)
+        while True:
+            try:
+                self._write_q.put_nowait(item)
+                break
+            except queue.Full:
+                try:
+                    self._write_q.get_nowait()
+                    self._write_q.task_done()
+                except queue.Empty:
+                    pass
+
+
+    def CCDwaitWrite(self):
+        # wait until queued image has been written
+        self._write_q.join()
+
+
+    def _writer(self):
+        while True:
+            img, exposure, gain = self._write_q.get()
+            try:
+                self._CCDwriteImg(img, exposure, gain)
+            except Exception as e:
+                # keep the thread alive, next image may succeed
+                warning(f"can't write image {Options.output}: {e}")
+            finally:
+                self._write_q.task_done()
+
+
+    def _CCDwriteImg(self, img, exposure, gain):
+        if Options.hot_pixels:
+            img = remove_hot_pixels(img)
+
         # Normalize to 0 .. 255
-        img = cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+        if img.dtype in (np.uint8, np.uint16):
+            # histogram based percentile stretch, hot pixels don't affect the scaling
+            nbins = 1 << (8 * img.itemsize)
+            cdf = cv2.calcHist([img], [0], None, [nbins], [0, nbins]).ravel().cumsum()
+            lo = np.searchsorted(cdf, STRETCH_LOW  * cdf[-1])
+            hi = np.searchsorted(cdf, STRETCH_HIGH * cdf[-1])
+            hi = max(hi, lo + 1)
+            lut = np.clip((np.arange(nbins) - lo) * (255 / (hi - lo)), 0, 255).astype(np.uint8)
+            img = lut[img]
+        else:
+            img = cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
 
         # add date
         font = cv2.FONT_HERSHEY_SIMPLEX
         # FIXME: position (360, 400) is very camera / binning specific!
-        txt_exp = f"{self.current_exposure:.2g}s (G{self.current_gain:d})"
+        txt_exp = f"{exposure:.2g}s (G{gain:d})"
         cv2.putText(img, time.ctime(), (360,460), font, .6, (255, 255, 255), 1, cv2.LINE_AA)
         cv2.putText(img, txt_exp, (20, 460), font, 0.6, (255, 255, 255), 1, cv2.LINE_AA)
-        cv2.imwrite(Options.output, img)
+
+        # write to temporary file and rename, readers never see a partial image
+        ext = os.path.splitext(Options.output)[1] or ".jpg"
+        # img is single channel uint8, encoded as grayscale JPEG
+        ok, buf = cv2.imencode(ext, img, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY,
+                                          cv2.IMWRITE_JPEG_OPTIMIZE, 1])
+        if not ok:
+            warning(f"can't encode image as {ext}")
+            return
+        tmp = Options.output + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(buf)
+        os.replace(tmp, Options.output)
+
+
+    def _capture_and_measure(self):
+        if DEBUG: ic("--- CAPTURE ---")
+        if DEBUG: ic(self.current_gain, self.current_offset, self.current_exposure)
+        self.CCDcapture()
+        img = self.CCDgetImg()
+        # mean in a single pass over a subsampled view
+        mean = cv2.mean(img[::AESTEP, ::AESTEP])[0]
+        if DEBUG: ic(mean)
+        return img, mean
 
 
     def CCDauto(self):
         count = MAXTRY
         low   = MEANADU - DEVADU
         high  = MEANADU + DEVADU
-        img   = None
-        last_exp_inc = False
-        last_exp_dec = False
-        last_gain_inc = False
-        last_gain_dec = False
-        last_exp = 0
-
-        while count > 0:
-            ic("--- ITERATION ---")
-            ic(count, self.current_gain, self.current_offset, self.current_exposure)
-            count -= 1
-            last_exp = self.current_exposure
-            self.CCDcapture()
-            img = self.CCDgetImg()
-            mean = np.average(img)
-            min  = np.min(img)
-            ic(low, high, mean, min)
-            if mean >= high:
-                # exposure too bright
-                if self.current_exposure <= EXPOSURE_THRESHOLD and self.current_gain > MINGAIN and not last_gain_inc:
-                    # decrease gain
-                    self.current_gain -= STEPGAIN
-                    if self.current_gain < MINGAIN: self.current_gain = MINGAIN
-                    last_gain_dec = True
-                else:
-                    # decrease exposure time
-                    if self.current_exposure <= MINEXP:
-                        self.current_exposure = MINEXP # just to be sure
-                        ic("already at MINEXP")
-                        break;
-                    new_exp = self.current_exposure / (1.4 if last_exp_inc else 2)
-                    if new_exp < MINEXP:
-                        new_exp = MINEXP
-                    self.current_exposure = new_exp
-                    last_exp_dec = True
-                    last_gain_dec = False
-                ic("too bright, new exposure:")
-                ic(self.current_exposure, self.current_gain)
-            elif mean <= low:
-                # exposure too dark
-                if self.current_exposure >= EXPOSURE_THRESHOLD and self.current_gain < MAXGAIN and not last_gain_dec:
-                    # increase gain
-                    self.current_gain += STEPGAIN
-                    if self.current_gain > MAXGAIN: self.current_gain = MAXGAIN
-                    last_gain_inc = True
-                else:
-                    # increase exposure time
-                    if self.current_exposure >= MAXEXP:
-                        self.current_exposure = MAXEXP # just to be sure
-                        ic("alreay at MAXEXP")
-                        break;
-                    new_exp = self.current_exposure * (1.4 if last_exp_dec else 2)
-                    if new_exp > MAXEXP:
-                        new_exp = MAXEXP
-                    self.current_exposure = new_exp
-                    last_gain_inc = False
-                    last_exp_inc  = True
-                ic("too dark, new exposure:")
-                ic(self.current_exposure, self.current_gain)
+        last_gain_step = 0
+
+        # Conditions change slowly in --loop mode, try last settings first
+        count -= 1
+        last_exp = self.current_exposure
+        img, mean = self._capture_and_measure()
+        if DEBUG: ic(low, high, mean)
+        # img, mean measured with current settings
+        measured = True
+
+        while not low < mean < high:
+            # Exposure time range for current gain: up to EXPOSURE_THRESHOLD with
+            # MINGAIN, above EXPOSURE_THRESHOLD only with MAXGAIN
+            min_exp = MINEXP if self.current_gain <= MINGAIN else EXPOSURE_THRESHOLD / EXPOSURE_RANGE
+            max_exp = MAXEXP if self.current_gain >= MAXGAIN else EXPOSURE_THRESHOLD
+            exp = min(max(self.current_exposure, min_exp), max_exp)
+            if exp != self.current_exposure:
+                self.current_exposure = exp
+                measured = False
+            # last too dark / too bright exposure time
+            lo_exp = None
+            hi_exp = None
+
+            while True:
+                if not measured:
+                    if count <= 0:
+                        break
+                    count -= 1
+                    last_exp = self.current_exposure
+                    img, mean = self._capture_and_measure()
+                measured = False
+                if low < mean < high:
+                    break
+                new_exp, lo_exp, hi_exp = ae_step(mean, last_exp, lo_exp, hi_exp, min_exp, max_exp)
+                if DEBUG: ic("new exposure:", new_exp)
+                if new_exp == last_exp:
+                    # limit of exposure time range reached
+                    break
+                self.current_exposure = new_exp
+
+            if low < mean < high or count <= 0:
+                break
+
+            # exposure time at limit, change gain
+            if mean <= low and self.current_gain < MAXGAIN:
+                gain_step = STEPGAIN
+            elif mean >= high and self.current_gain > MINGAIN:
+                gain_step = -STEPGAIN
             else:
-                # exposure ok
-                ic("ok, saving image")
+                if DEBUG: ic("already at gain/exposure limit")
                 break
+            if gain_step == -last_gain_step:
+                if DEBUG: ic("gain oscillating, giving up")
+                break
+            last_gain_step = gain_step
+            self.current_gain = min(max(self.current_gain + gain_step, MINGAIN), MAXGAIN)
+            if DEBUG: ic("new gain:", self.current_gain)
 
+        if DEBUG and low < mean < high: ic("ok, saving image")
         verbose(f"auto-exposure {last_exp:.3g}s gain={self.current_gain} mean={mean:.0f}")
         self.CCDwriteImg(img)
 
@@ -353,17 +585,20 @@ def main():
     arg.add_argument("-v", "--verbose", action="store_true", help="verbose messages")
     arg.add_argument("-d", "--debug", action="store_true", help="more debug messages")
     arg.add_argument("-M", "--new-message", action="store_true", help="verbose log new INDI messages")
-    arg.add_argument("-c", "--camera", help=f"camera name (default {Options.camera})")
-    arg.add_argument("-g", "--gain", type=int, help=f"initial camera gain (default: {Options.gain})")
-    arg.add_argument("-o", "--offset", type=int, help=f"initial camera offset (default: {Options.offset})")
-    arg.add_argument("-b", "--binning", type=int, help=f"initial camera binning, 1 (1x1) or 2 (2x2) (default: {Options.binning})")
-    arg.add_argument("-e", "--exposure", type=float, help=f"initial camera exposure time/s (default: {Options.exposure})")
+    arg.add_argument("-c", "--camera", default=Options.camera, help=f"camera name (default {Options.camera})")
+    arg.add_argument("-g", "--gain", type=int, default=Options.gain, help=f"initial camera gain (default: {Options.gain})")
+    arg.add_argument("-o", "--offset", type=int, default=Options.offset, help=f"initial camera offset (default: {Options.offset})")
+    arg.add_argument("-b", "--binning", type=int, default=Options.binning, help=f"initial camera binning, 1 (1x1) or 2 (2x2) (default: {Options.binning})")
+    arg.add_argument("-e", "--exposure", type=float, default=Options.exposure, help=f"initial camera exposure time/s (default: {Options.exposure})")
     arg.add_argument("-l", "--loop", type=float, help=f"loop exposure, interval LOOP s")
-    arg.add_argument("-O", "--output", help=f"output JPG file {Options.output})")
+    arg.add_argument("-O", "--output", default=Options.output, help=f"output JPG file {Options.output})")
+    arg.add_argument("-H", "--hot-pixels", action="store_true", help="remove hot pixels from output image")
 
     args = arg.parse_args()
 
     if args.debug:
+        global DEBUG
+        DEBUG = True
         ic.enable()
         ic(sys.version_info)
         ic(args)
@@ -371,24 +606,18 @@ def main():
         verbose.set_prog(NAME)
         verbose.enable()
     # ... more options ...
-    if args.new_message:
-        Options.new_message = True
-    if args.camera:
-        Options.camera = args.camera
-    if args.gain:
-        Options.gain  = args.gain
-    if args.offset:
-        Options.offset  = args.offset
-    if args.binning:
-        Options.binning  = args.binning
-        if Options.binning != 1 and Options.binning != 2:
-            error("argument -b/--binning: must be 1 or 2")
-    if args.exposure:
-        Options.exposure = float(args.exposure)
-        if Options.exposure <= 0:
-            error("argument -e/--exposure: must be > 0")
-    if args.output:
-        Options.output = args.output
+    Options.new_message = args.new_message
+    Options.camera     = args.camera
+    Options.gain       = args.gain
+    Options.offset     = args.offset
+    Options.binning    = args.binning
+    if Options.binning != 1 and Options.binning != 2:
+        error("argument -b/--binning: must be 1 or 2")
+    Options.exposure   = args.exposure
+    if Options.exposure <= 0:
+        error("argument -e/--exposure: must be > 0")
+    Options.output     = args.output
+    Options.hot_pixels = args.hot_pixels
         
     # Connect to the server
     indi = IndiClient("localhost", 7624)
@@ -406,21 +635,35 @@ def main():
         verbose(f"looping exposure every {loop} s ... Crtl-C to interrupt")
         try:
             # looping exposure
+            # Each capture depends on the auto-exposure result of the previous
+            # one, post-processing and writing of the final image run in the
+            # writer thread and overlap with the next cycle
+            # Fixed schedule start + k * loop, no drift. If CCDauto() overruns,
+            # missed slots are skipped instead of starting back-to-back.
+            start = time.perf_counter()
+            k = 0
             while True:
-                t1 = time.perf_counter()
-                indi.CCDauto()
-                t2 = time.perf_counter()
-                sleep = loop - (t2 - t1)
-                if(sleep > 0):
-                    time.sleep(sleep)
+                try:
+                    indi.CCDauto()
+                except TimeoutError as e:
+                    # late or lost frame, skip this cycle
+                    warning(e)
+                now = time.perf_counter()
+                k = max(k + 1, math.ceil((now - start) / loop))
+                # rounding may put the slot slightly before now
+                time.sleep(max(0.0, start + k * loop - now))
         except KeyboardInterrupt:
             # Catch Ctrl-C
             verbose("looping interrupted, terminating")
             pass
     else:
-        indi.CCDauto()
+        try:
+            indi.CCDauto()
+        except TimeoutError as e:
+            error(e)
 
     # Disconnect from the indiserver
+    indi.CCDwaitWrite()
     indi.disconnectServer()
 
 
@@ -17,12 +17,18 @@
 # ChangeLog
 # Version 0.1 / 2024-05-14
 #       First version with INDI client from tutorial client
+# Version 0.2 / 2026-10-15
+#       Faster image acquisition
+#       Write blob.png instead of blob.jpg, keeping the sensor bit depth
+#       Added raw option
 
 # Standard library
 import sys
 import argparse
 import time
 import threading
+import queue
+import concurrent.futures
 
 # Extra modules, not part of standard library, on Ubuntu install via apt-get
 import PyIndi
@@ -37,19 +43,33 @@ ic.disable()
 from verbose import verbose, warning, error
 
 
-VERSION = "0.1 / 2024-05-14"
+VERSION = "0.2 / 2026-10-15"
 AUTHOR  = "Martin Junius"
 NAME    = "qhy5-capture"
 DESC    = "INDI client, capture frame from QHY5L"
 
-# INDI timeout for getXXX() functions (seconds)
-TIMEOUT = 0.1
+# Max. time between checks for INDI devices and properties (seconds),
+# new devices / properties wake up the waiting getXXX() immediately
+TIMEOUT = 1.0
+# Rows per block for parallel image statistics
+TILEROWS = 256
 # Default server:port
 HOST    = "localhost"
 PORT    = 7624
 
 
 
+# INDI property types as strings, avoids getTypeAsString() calls
+_TYPE_STR = {
+    PyIndi.INDI_NUMBER:  "INDI_NUMBER",
+    PyIndi.INDI_SWITCH:  "INDI_SWITCH",
+    PyIndi.INDI_TEXT:    "INDI_TEXT",
+    PyIndi.INDI_LIGHT:   "INDI_LIGHT",
+    PyIndi.INDI_BLOB:    "INDI_BLOB",
+    PyIndi.INDI_UNKNOWN: "INDI_UNKNOWN",
+}
+
+
 # QHY 5L ii mono:
 #   gain 1 ... 29
 #   offset 1 ... 512; +100 -> ~+25 ADU min value
@@ -61,6 +81,34 @@ class Options:
     offset   = 1                            # -o --offset       1 ... 512
     exposure = 0.1                          # -e --exposure
     binning  = 2                            # -b --binning
+    raw      = False                        # -R --raw
+
+
+
+# Mean, min, max of image in a single pass over the data: for 8/16 bit
+# images all three are derived from the histogram, computed in parallel
+# for blocks of TILEROWS rows (OpenCV releases the GIL)
+def image_stats(img):
+    if img.dtype not in (np.uint8, np.uint16):
+        return np.average(img), np.min(img), np.max(img)
+    nbins = 1 << (8 * img.itemsize)
+    tiles = [img[i:i + TILEROWS] for i in range(0, img.shape[0], TILEROWS)]
+    calc  = lambda tile: cv2.calcHist([tile], [0], None, [nbins], [0, nbins]).ravel()
+    if len(tiles) > 1:
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            hist = sum(pool.map(calc, tiles))
+    else:
+        hist = calc(img)
+    nz = np.flatnonzero(hist)
+    mean = np.dot(hist, np.arange(nbins)) / img.size
+    return mean, nz[0], nz[-1]
+
+
+
+# Verbose output of all elements of an INDI property in one line
+def _verbose_list(name, list):
+    if verbose:
+        verbose(f"{name}: {', '.join(f'{i.getName()}={i.getValue()}' for i in list)}")
 
 
 
@@ -69,6 +117,15 @@ class IndiClient(PyIndi.BaseClient):
     def __init__(self, host=HOST, port=PORT):
         super(IndiClient, self).__init__()
         verbose(f"creating an instance of IndiClient, server {host}:{port}")
+        # set by callbacks when new devices / properties arrive
+        self._prop_event = threading.Event()
+        # worker for writing images
+        self._io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._io_futures = []
+        # blob format and data, passed from updateProperty() to CCDprocessData()
+        self._blob_q = queue.SimpleQueue()
+        # frame buffer, allocated by CCDcapture()
+        self._frame = None
         self.setServer(host, port)
         if not self.connectServer():
             error("can't connect to indiserver")
@@ -77,6 +134,7 @@ class IndiClient(PyIndi.BaseClient):
     def newDevice(self, d):
         """Emmited when a new device is created from INDI server."""
         verbose(f"new device {d.getDeviceName()}")
+        self._prop_event.set()
 
     def removeDevice(self, d):
         """Emmited when a device is deleted from INDI server."""
@@ -84,25 +142,23 @@ class IndiClient(PyIndi.BaseClient):
 
     def newProperty(self, p):
         """Emmited when a new property is created for an INDI driver."""
-        verbose(
-            f"new property {p.getName()} as {p.getTypeAsString()} for device {p.getDeviceName()}"
-        )
-
-    # def updateProperty(self, p):
-    #     """Emmited when a new property value arrives from INDI server."""
-    #     verbose(
-    #         f"update property {p.getName()} as {p.getTypeAsString()} for device {p.getDeviceName()}"
-    #     )
+        if verbose:
+            verbose(
+                f"new property {p.getName()} as {_TYPE_STR.get(p.getType())} for device {p.getDeviceName()}"
+            )
+        self._prop_event.set()
 
     def removeProperty(self, p):
         """Emmited when a property is deleted for an INDI driver."""
-        verbose(
-            f"remove property {p.getName()} as {p.getTypeAsString()} for device {p.getDeviceName()}"
-        )
+        if verbose:
+            verbose(
+                f"remove property {p.getName()} as {_TYPE_STR.get(p.getType())} for device {p.getDeviceName()}"
+            )
 
     def newMessage(self, d, m):
         """Emmited when a new message arrives from INDI server."""
-        verbose(f"new Message {d.messageQueue(m)}")
+        if verbose:
+            verbose(f"new Message {d.messageQueue(m)}")
 
     def serverConnected(self):
         """Emmited when the server is connected."""
@@ -117,70 +173,103 @@ class IndiClient(PyIndi.BaseClient):
 
     def updateProperty(self, prop):
         """Emmited when a new property value arrives from INDI server."""
-        verbose(f"update property {prop.getName()} as {prop.getTypeAsString()} for device {prop.getDeviceName()}")
-        global blobEvent
-        if prop.getType() == PyIndi.INDI_BLOB:
-            print("new BLOB ", prop.getName())
-            blobEvent.set()
+        # called for every property update, only BLOBs need processing
+        if (ptype := prop.getType()) != PyIndi.INDI_BLOB:
+            if verbose:
+                verbose(f"update property {prop.getName()} as {_TYPE_STR.get(ptype)} for device {prop.getDeviceName()}")
+            self._prop_event.set()
+            return
+
+        print("new BLOB ", prop.getName())
+        # take the data before signalling, CCD1 is the only blob of the property
+        blob = PyIndi.PropertyBlob(prop)[0]
+        if verbose:
+            verbose(f"name: {blob.getName()} size: {blob.getSize()} format: {blob.getFormat()}")
+        self._blob_q.put((blob.getFormat(), blob.getblobdata()))
+
+
+    # Wait until fn(*args) returns a valid device / property
+    def _wait_for(self, fn, *args):
+        while not (v := fn(*args)):
+            self._prop_event.clear()
+            # may have arrived before clear()
+            if (v := fn(*args)):
+                break
+            self._prop_event.wait(TIMEOUT)
+        return v
 
 
     # Refactored from main()
     def verboseDevices(self):
         # list devices
-        while not (deviceList := self.getDevices()):
-            time.sleep(TIMEOUT)
+        deviceList = self._wait_for(self.getDevices)
         for device in deviceList:
             verbose(f"device found: {device.getDeviceName()}")
 
 
-    def getCCDAttr(self, name):
-        while not (attr := self.device_ccd.getNumber(name)):
-            time.sleep(TIMEOUT)
-        return attr
-            
-
     def CCDconnect(self, ccd):
         # Connect camera
-        while not (device_ccd := self.getDevice(ccd)):
-            time.sleep(TIMEOUT)
+        wait = self._wait_for
+        device_ccd = wait(self.getDevice, ccd)
         self.device_ccd = device_ccd
-        while not (ccd_connect := device_ccd.getSwitch("CONNECTION")):
-            time.sleep(TIMEOUT)
+        # bound methods, avoids repeated attribute lookups
+        gN = device_ccd.getNumber
+        gS = device_ccd.getSwitch
+        gB = device_ccd.getBLOB
+        ccd_connect = wait(gS, "CONNECTION")
         if not device_ccd.isConnected():
             ccd_connect.reset()
             ccd_connect[0].setState(PyIndi.ISS_ON)  # the "CONNECT" switch
             self.sendNewProperty(ccd_connect)
 
-        self.ccd_exposure = self.getCCDAttr("CCD_EXPOSURE")
-        self.ccd_binning  = self.getCCDAttr("CCD_BINNING")
-        self.ccd_gain     = self.getCCDAttr("CCD_GAIN")
-        self.ccd_offset   = self.getCCDAttr("CCD_OFFSET")
-        self.ccd_info     = self.getCCDAttr("CCD_INFO")
+        self.ccd_exposure = wait(gN, "CCD_EXPOSURE")
+        self.ccd_binning  = wait(gN, "CCD_BINNING")
+        self.ccd_gain     = wait(gN, "CCD_GAIN")
+        self.ccd_offset   = wait(gN, "CCD_OFFSET")
+        self.ccd_info     = wait(gN, "CCD_INFO")
+
+        # request raw image data instead of FITS, if supported by the driver.
+        # Always set, the driver is shared with qhy5-auto and keeps the format
+        # of the last client.
+        if (ccd_format := gS("CCD_TRANSFER_FORMAT")):
+            fmt = "FORMAT_NATIVE" if Options.raw else "FORMAT_FITS"
+            for sw in ccd_format:
+                sw.setState(PyIndi.ISS_ON if sw.getName() == fmt else PyIndi.ISS_OFF)
+            self.sendNewProperty(ccd_format)
+        elif Options.raw:
+            warning("driver doesn't support CCD_TRANSFER_FORMAT, using FITS")
 
         # inform the indi server that we want to receive the "CCD1" blob from this device
         self.setBLOBMode(PyIndi.B_ALSO, ccd, "CCD1")
-        while not (ccd_ccd1 := device_ccd.getBLOB("CCD1")):
-            time.sleep(TIMEOUT)
-        self.ccd_ccd1 = ccd_ccd1
+        self.ccd_ccd1 = wait(gB, "CCD1")
 
-        # we use here the threading.Event facility of Python
-        global blobEvent
-        blobEvent = threading.Event()
+
+    # Frame shape and dtype from CCD_INFO and binning
+    def frameInfo(self, bin):
+        info  = {i.getName(): i.getValue() for i in self.ccd_info}
+        shape = (int(info["CCD_MAX_Y"]) // bin, int(info["CCD_MAX_X"]) // bin)
+        dtype = np.dtype(np.uint8 if info["CCD_BITSPERPIXEL"] <= 8 else np.uint16)
+        return shape, dtype
 
 
     def CCDcapture(self, gain, offset, bin, exp):
-        # set gain and offset
+        # frame buffer for CCDprocessData(), reused as long as the size doesn't change
+        shape, dtype = self.frameInfo(bin)
+        if self._frame is None or self._frame.shape != shape or self._frame.dtype != dtype:
+            self._frame = np.empty(shape, dtype=dtype)
+
+        # set gain, offset, binning, then send back-to-back
         self.ccd_gain[0].setValue(gain)
-        self.sendNewProperty(self.ccd_gain)
         self.ccd_offset[0].setValue(offset)
-        self.sendNewProperty(self.ccd_offset)
-        # set binning
         self.ccd_binning[0].setValue(bin)
         self.ccd_binning[1].setValue(bin)
+        self.sendNewProperty(self.ccd_gain)
+        self.sendNewProperty(self.ccd_offset)
         self.sendNewProperty(self.ccd_binning)
 
-        # start exposure
-        blobEvent.clear()
+        # start exposure, drop stale blobs
+        while not self._blob_q.empty():
+            self._blob_q.get_nowait()
         self.ccd_exposure[0].setValue(exp)
         self.sendNewProperty(self.ccd_exposure)
 
@@ -188,55 +277,76 @@ class IndiClient(PyIndi.BaseClient):
 
 
     def CCDprocessData(self):
-        # wait for exposure(s)
-        blobEvent.wait()
-        # seems to help with early terminate errors
-        time.sleep(0.1)
-
-        # process the received one
-        for blob in self.ccd_ccd1:
-            verbose(
-                "name: ",
-                blob.getName(),
-                " size: ",
-                blob.getSize(),
-                " format: ",
-                blob.getFormat(),
-            )
-            fitsdata = blob.getblobdata()
-            print("fits data type: ", type(fitsdata))
-
-            # Directly convert bytearray to FITS
-            hdul = fits.HDUList.fromstring(bytes(fitsdata))
+        # wait for exposure(s), data taken by updateProperty()
+        format, blobdata = self._blob_q.get()
+        print("blob data type: ", type(blobdata))
+        frame = self._frame
+
+        if format.startswith(".fits"):
+            # Directly convert to FITS, astropy parses bytes in place, but needs
+            # a copy of other buffer types like bytearray
+            if not isinstance(blobdata, bytes):
+                blobdata = bytes(blobdata)
+            # unscaled data is a view on the blob data
+            hdul = fits.HDUList.fromstring(blobdata, do_not_scale_image_data=True)
             hdul.info()
-            imgdata = hdul[0].data
-
-            # Evaluate data
-            mean = np.average(imgdata)
-            min  = np.min(imgdata)
-            max  = np.max(imgdata)
-            print(imgdata)
-            print(mean, min, max)
-
-            # add date
-            font = cv2.FONT_HERSHEY_SIMPLEX
-            # FIXME: position (360, 400) is very camera / binning specific!
-            cv2.putText(imgdata, time.ctime(), (360,460), font, .6, (255), 1, cv2.LINE_AA)
-
-            cv2.imwrite("blob.jpg", imgdata)
+            hdu  = hdul[0]
+            data = hdu.data
+            if data.shape == frame.shape and hdu.header.get("BSCALE", 1) == 1 and \
+               (data.dtype.itemsize, hdu.header.get("BZERO", 0)) == ((1, 0) if frame.dtype == np.uint8 else (2, 32768)):
+                if frame.dtype == np.uint8:
+                    np.copyto(frame, data)
+                else:
+                    # big endian signed with BZERO=32768 -> native uint16 in a single pass
+                    np.bitwise_xor(data.view(">u2"), np.uint16(0x8000), out=frame)
+                imgdata = frame
+            else:
+                # other layout, let astropy scale the data
+                imgdata = fits.HDUList.fromstring(blobdata)[0].data
+                # FITS data may be big endian, convert once to native byte order
+                # and C order for the numpy / OpenCV functions below
+                imgdata = np.ascontiguousarray(imgdata.astype(imgdata.dtype.newbyteorder("="), copy=False))
+        else:
+            # Raw pixel data, frame size from CCD_INFO and binning
+            if len(blobdata) != frame.nbytes:
+                error(f"raw image data size {len(blobdata)} doesn't match frame {frame.shape[1]}x{frame.shape[0]} {frame.dtype}")
+            np.copyto(frame, np.frombuffer(blobdata, dtype=frame.dtype).reshape(frame.shape))
+            imgdata = frame
+
+        # Evaluate data
+        mean, min, max = image_stats(imgdata)
+        print(f"image shape={imgdata.shape} dtype={imgdata.dtype}")
+        print(mean, min, max)
+
+        # add date
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        # FIXME: position (360, 400) is very camera / binning specific!
+        white = np.iinfo(imgdata.dtype).max if imgdata.dtype.kind in "ui" else 255
+        cv2.putText(imgdata, time.ctime(), (360,460), font, .6, (white), 1, cv2.LINE_AA)
+
+        # PNG keeps 8/16 bit sensor data, fast compression level, written by worker
+        self._io_futures.append(
+            self._io_pool.submit(cv2.imwrite, "blob.png", imgdata.copy(), [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        )
 
 
-    def _verbose_list(name, list):
-        for i in list:
-            verbose(name+":", i.getName(), "=", i.getValue())
+    def CCDwaitWrite(self):
+        # wait for pending image writes
+        for f in concurrent.futures.as_completed(self._io_futures):
+            try:
+                if not f.result():
+                    warning("writing image failed")
+            except Exception as e:
+                warning(f"writing image failed: {e}")
+        self._io_futures = []
 
 
     def verboseCCDAttr(self):
-        IndiClient._verbose_list("CCD exposure", self.ccd_exposure)
-        IndiClient._verbose_list("CCD binning",  self.ccd_binning)
-        IndiClient._verbose_list("CCD gain",     self.ccd_gain)
-        IndiClient._verbose_list("CCD offset",   self.ccd_offset)
-        # IndiClient._verbose_list("CCD info",     self.ccd_info)
+        _verbose_list("CCD exposure", self.ccd_exposure)
+        _verbose_list("CCD binning",  self.ccd_binning)
+        _verbose_list("CCD gain",     self.ccd_gain)
+        _verbose_list("CCD offset",   self.ccd_offset)
+        # _verbose_list("CCD info",     self.ccd_info)
 
 
 
@@ -252,6 +362,7 @@ def main():
     arg.add_argument("-o", "--offset", type=int, help="camera offset")
     arg.add_argument("-b", "--binning", type=int, help="camera binning, 1 (1x1) or 2 (2x2)")
     arg.add_argument("-e", "--exposure", type=float, help="camera exposure time/s")
+    arg.add_argument("-R", "--raw", action="store_true", help="request raw image data instead of FITS")
 
     args = arg.parse_args()
 
@@ -277,6 +388,8 @@ def main():
         Options.exposure = float(args.exposure)
         if Options.exposure <= 0:
             error("argument -e/--exposure: must be > 0")
+    if args.raw:
+        Options.raw = True
         
     # Connect to the server
     indi = IndiClient("localhost", 7624)
@@ -291,6 +404,7 @@ def main():
     indi.CCDprocessData()
 
     # Disconnect from the indiserver
+    indi.CCDwaitWrite()
     indi.disconnectServer()
 
 
@@ -19,6 +19,8 @@
 #       First version of verbose module
 # Version 0.2 / 2023-12-18
 #       Added warning(), error() with abort
+# Version 1.1 / 2026-10-15
+#       Added truth value test for enabled
 #
 #       Usage:  from verbose import verbose, warning, error
 #               verbose(print-like-args)
@@ -28,6 +30,8 @@
 #               .disable()
 #               .set_prog(name)         global for all objects
 #               .set_errno(errno)       relevant only for error()
+#               if verbose: ...         True if enabled, skip building
+#                                       expensive messages otherwise
 
 import argparse
 import sys
@@ -39,7 +43,7 @@ ic.disable()
 
 
 global VERSION, AUTHOR, NAME
-VERSION = "1.0 / 2024-01-06"
+VERSION = "1.1 / 2026-10-15"
 AUTHOR  = "Martin Junius"
 NAME    = "verbose"
 
@@ -65,6 +69,9 @@ class Verbose:
         if self.abort:
             self._exit()
 
+    def __bool__(self):
+        return self.enabled
+
     def enable(self, flag=True):
         self.enabled = flag
 